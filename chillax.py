@@ -5,14 +5,20 @@ Chillax MCP Server - 天気に基づいた過ごし方提案サーバー
 カスケード処理の実例としてのMCPサーバー実装
 """
 
+import asyncio
+import atexit
+import contextlib
 import os
-import json
+from dataclasses import dataclass
 from datetime import datetime, timedelta
-from typing import List, Dict, Any, Optional
+from functools import lru_cache
+from typing import List, Dict, Any, Optional, Tuple, Union
 from enum import Enum
 from dotenv import load_dotenv
 
 import httpx
+import orjson
+from cachetools import TTLCache
 from mcp.server.fastmcp import FastMCP
 
 # Initialize FastMCP server
@@ -27,6 +33,73 @@ YOUTUBE_API_KEY = os.getenv("YOUTUBE_API_KEY")
 OPENWEATHER_BASE_URL = "https://api.openweathermap.org/data/2.5/forecast"
 YOUTUBE_BASE_URL = "https://www.googleapis.com/youtube/v3/search"
 
+# レスポンスキャッシュ
+# OpenWeatherのデータは約10分周期でしか更新されないため、同一都市への
+# 連続リクエストはキャッシュで返す。YouTubeの検索結果も短時間は安定している
+_weather_cache: TTLCache[Tuple[str, int], "WeatherInfo"] = TTLCache(maxsize=1024, ttl=600)
+_video_cache: TTLCache[Tuple["WeatherCondition", "Language"], List[Dict[str, Any]]] = TTLCache(maxsize=64, ttl=300)
+
+# 共有HTTPクライアント（コネクションプール）
+# 呼び出しごとにAsyncClientを作り直すとTCP+TLSハンドシェイクが毎回発生するため、
+# keep-alive付きのクライアントを1つだけ持ち回して接続を再利用する
+_http_client: Optional[httpx.AsyncClient] = None
+
+# 各リクエストのフェーズ別タイムアウト。遅い外部APIにツール全体を
+# 引きずらせず、早めに失敗させて部分的な結果を返せるようにする
+_REQUEST_TIMEOUT = httpx.Timeout(connect=2.0, read=4.0, write=2.0, pool=1.0)
+
+# YouTube検索のファンアウト全体に許す上限秒数
+_SEARCH_DEADLINE = 5.0
+
+
+def _get_http_client() -> httpx.AsyncClient:
+    """共有AsyncClientを遅延生成して返す（イベントループ内で初回アクセスされる前提）"""
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = httpx.AsyncClient(
+            http2=True,
+            timeout=httpx.Timeout(10.0, connect=3.0),
+            limits=httpx.Limits(
+                max_connections=100,
+                max_keepalive_connections=30,
+                keepalive_expiry=60,
+            ),
+        )
+    return _http_client
+
+
+def _close_http_client() -> None:
+    """プロセス終了時に共有クライアントを閉じる"""
+    if _http_client is not None and not _http_client.is_closed:
+        with contextlib.suppress(Exception):
+            asyncio.run(_http_client.aclose())
+
+
+atexit.register(_close_http_client)
+
+
+# 実行中のウォームアップタスクへの参照（イベントループは弱参照しか持たないため、
+# ここで保持しておかないと完了前にGCされうる）
+_warm_tasks: set = set()
+
+
+async def _warm_youtube() -> None:
+    """YouTube APIへの接続（DNS解決とTLSハンドシェイク）を先回りして温める"""
+    with contextlib.suppress(httpx.HTTPError):
+        await _get_http_client().head(YOUTUBE_BASE_URL, timeout=_REQUEST_TIMEOUT)
+
+
+def _spawn_warm_youtube() -> None:
+    """ウォームアップをバックグラウンドで開始する
+
+    天気取得が先に終わってもキャンセルはしない。ハンドシェイク中に中断すると
+    せっかく張りかけた接続が捨てられ、直後の動画検索で張り直すことになるため、
+    完了までkeep-aliveプールに合流させる（タイムアウトは_REQUEST_TIMEOUTで抑制済み）
+    """
+    task = asyncio.create_task(_warm_youtube())
+    _warm_tasks.add(task)
+    task.add_done_callback(_warm_tasks.discard)
+
 # 定数
 class WeatherCondition(Enum):
     PERFECT = "perfect"  # 晴れ/曇り、快適な気温
@@ -41,6 +114,42 @@ class Language(Enum):
     KO = "ko"
     ZH = "zh"
 
+@dataclass(frozen=True, slots=True)
+class WeatherInfo:
+    """get_weather_forecastの正常系の戻り値
+
+    内部の受け渡しは属性アクセスで行い（dictのハッシュ参照やEnumと文字列の
+    往復変換を避ける）、MCPレスポンスの境界でのみto_dict()で辞書化する
+    """
+
+    city: str
+    date: str
+    main: str
+    description: str
+    temperature: float
+    temp_min: float
+    temp_max: float
+    humidity: int
+    condition: WeatherCondition
+    language: Language
+
+    def to_dict(self) -> Dict[str, Any]:
+        """MCPレスポンス用の辞書表現（従来の返却フォーマットと同一）"""
+        return {
+            "city": self.city,
+            "date": self.date,
+            "weather": {
+                "main": self.main,
+                "description": self.description,
+                "temperature": self.temperature,
+                "temp_min": self.temp_min,
+                "temp_max": self.temp_max,
+                "humidity": self.humidity,
+            },
+            "condition": self.condition.value,
+            "language": self.language.value,
+        }
+
 # 都市名から言語を推測するマッピング
 CITY_LANGUAGE_MAP = {
     # 日本
@@ -69,6 +178,10 @@ CITY_LANGUAGE_MAP = {
     "上海": Language.ZH,
 }
 
+# キーを正規化（小文字化・前後空白除去）した参照用テーブル。
+# 元のマップはすでに正規化済みだが、今後エントリを足しても検索側が壊れないよう明示しておく
+_CITY_LANG_NORMALIZED = {k.lower().strip(): v for k, v in CITY_LANGUAGE_MAP.items()}
+
 # 天気条件に応じた検索クエリテンプレート
 SEARCH_QUERIES = {
     WeatherCondition.PERFECT: {
@@ -93,11 +206,30 @@ SEARCH_QUERIES = {
     },
 }
 
+# (天気条件, 言語) → クエリリストを英語フォールバック込みでインポート時に展開しておく
+# リクエストごとの .get() チェーンを1回のハッシュ参照に置き換える
+_QUERY_TABLE: Dict[tuple, List[str]] = {
+    (cond, lang): by_lang.get(lang, by_lang[Language.EN])
+    for cond, by_lang in SEARCH_QUERIES.items()
+    for lang in Language
+}
+
+# 言語 → YouTube検索のregionCode（リクエストごとの文字列スライス+大文字化を排除）
+_REGION_CODE = {
+    Language.JA: "JP",
+    Language.EN: "US",
+    Language.KO: "KR",
+    Language.ZH: "CN",
+}
 
+
+@lru_cache(maxsize=512)
 def detect_language(city: str) -> Language:
     """都市名から言語を推測"""
+    # 同じ都市が繰り返し問い合わせられるサーバーなので、lru_cacheにより
+    # 2回目以降はlower/stripの文字列生成すら発生しない
     city_lower = city.lower().strip()
-    return CITY_LANGUAGE_MAP.get(city_lower, Language.EN)
+    return _CITY_LANG_NORMALIZED.get(city_lower, Language.EN)
 
 
 def categorize_weather(weather_data: Dict[str, Any]) -> WeatherCondition:
@@ -126,23 +258,28 @@ def categorize_weather(weather_data: Dict[str, Any]) -> WeatherCondition:
     return WeatherCondition.PERFECT
 
 
-async def get_weather_forecast(city: str, days_ahead: int = 0) -> Dict[str, Any]:
+async def get_weather_forecast(city: str, days_ahead: int = 0) -> Union[WeatherInfo, Dict[str, Any]]:
     """
     指定した都市の天気予報を取得
-    
+
     Args:
         city: 都市名（例: "Tokyo", "London"）
         days_ahead: 何日後の予報を取得するか（0=今日、1=明日、最大5）
-    
+
     Returns:
-        天気情報と分析結果
+        天気情報と分析結果（エラー時は"error"キーを持つdict）
     """
     if not OPENWEATHER_API_KEY:
         return {"error": "OpenWeatherMap API key not configured"}
     
     if days_ahead < 0 or days_ahead > 5:
         return {"error": "days_ahead must be between 0 and 5"}
-    
+
+    # キャッシュにあればAPIを呼ばずに返す
+    cache_key = (city.lower().strip(), days_ahead)
+    if cache_key in _weather_cache:
+        return _weather_cache[cache_key]
+
     # 言語を検出
     language = detect_language(city)
     
@@ -154,31 +291,43 @@ async def get_weather_forecast(city: str, days_ahead: int = 0) -> Dict[str, Any]
         "lang": language.value,
     }
     
-    async with httpx.AsyncClient() as client:
-        try:
-            response = await client.get(OPENWEATHER_BASE_URL, params=params)
-            response.raise_for_status()
-            data = response.json()
-        except httpx.HTTPError as e:
-            return {"error": f"Failed to fetch weather data: {str(e)}"}
+    client = _get_http_client()
+    try:
+        response = await client.get(OPENWEATHER_BASE_URL, params=params, timeout=_REQUEST_TIMEOUT)
+        response.raise_for_status()
+        # 約30KBのレスポンスを標準のjsonより数倍速くデコードできる
+        data = orjson.loads(response.content)
+    except httpx.HTTPError as e:
+        return {"error": f"Failed to fetch weather data: {str(e)}"}
     
     # 指定日時の予報を探す
     target_date = datetime.now() + timedelta(days=days_ahead)
     target_date_str = target_date.strftime("%Y-%m-%d")
-    
+
     # 該当日の予報を抽出（12時頃のデータを優先）
-    forecast_list = data.get("list", [])
+    # 予報リストを（ローカル日, ローカル時刻）で一度だけインデックス化し、
+    # 線形スキャンの代わりに希望時刻を優先順にO(1)で引き当てる
+    day_start = int(target_date.replace(hour=0, minute=0, second=0, microsecond=0).timestamp())
+    utc_offset = target_date.astimezone().utcoffset()
+    assert utc_offset is not None  # astimezone()は必ずawareなdatetimeを返す
+    tz_offset = int(utc_offset.total_seconds())
+    target_day = (day_start + tz_offset) // 86400
+
+    by_day: Dict[int, Dict[int, Dict[str, Any]]] = {}
+    for forecast in data.get("list", []):
+        local_ts = forecast["dt"] + tz_offset
+        by_day.setdefault(local_ts // 86400, {})[(local_ts // 3600) % 24] = forecast
+
     target_forecast = None
-    
-    for forecast in forecast_list:
-        forecast_time = datetime.fromtimestamp(forecast["dt"])
-        if forecast_time.strftime("%Y-%m-%d") == target_date_str:
-            # 12時に最も近い予報を選択
-            if forecast_time.hour >= 11 and forecast_time.hour <= 13:
-                target_forecast = forecast
+    by_hour = by_day.get(target_day)
+    if by_hour:
+        # 12時に最も近い予報を選択（11〜13時を優先し、なければその日の最初の予報）
+        for hour in (11, 12, 13):
+            if hour in by_hour:
+                target_forecast = by_hour[hour]
                 break
-            elif target_forecast is None:
-                target_forecast = forecast
+        else:
+            target_forecast = by_hour[min(by_hour)]
     
     if not target_forecast:
         return {"error": f"No forecast available for {days_ahead} days ahead"}
@@ -187,119 +336,176 @@ async def get_weather_forecast(city: str, days_ahead: int = 0) -> Dict[str, Any]
     weather_condition = categorize_weather(target_forecast)
     
     # 結果を整形
-    result = {
-        "city": city,
-        "date": target_date_str,
-        "weather": {
-            "main": target_forecast["weather"][0]["main"],
-            "description": target_forecast["weather"][0]["description"],
-            "temperature": target_forecast["main"]["temp"],
-            "temp_min": target_forecast["main"]["temp_min"],
-            "temp_max": target_forecast["main"]["temp_max"],
-            "humidity": target_forecast["main"]["humidity"],
-        },
-        "condition": weather_condition.value,
-        "language": language.value,
-    }
-    
+    weather_main = target_forecast["weather"][0]
+    main_block = target_forecast["main"]
+    result = WeatherInfo(
+        city=city,
+        date=target_date_str,
+        main=weather_main["main"],
+        description=weather_main["description"],
+        temperature=main_block["temp"],
+        temp_min=main_block["temp_min"],
+        temp_max=main_block["temp_max"],
+        humidity=main_block["humidity"],
+        condition=weather_condition,
+        language=language,
+    )
+
+    # エラーはキャッシュしない（ここまで来れば正常系のみ）
+    _weather_cache[cache_key] = result
     return result
 
-async def suggest_videos(weather_info: Dict[str, Any]) -> List[Dict[str, Any]]:
+def _build_video(item: Dict[str, Any], query: str) -> Dict[str, Any]:
+    """YouTube検索結果の1件を返却用のdictに整形"""
+    snippet = item["snippet"]
+    description = snippet["description"]
+    if len(description) > 200:
+        description = description[:200] + "..."
+    return {
+        "title": snippet["title"],
+        "channel": snippet["channelTitle"],
+        "description": description,
+        "url": f"https://www.youtube.com/watch?v={item['id']['videoId']}",
+        "thumbnail": snippet["thumbnails"]["medium"]["url"],
+        "search_query": query,
+    }
+
+
+async def _fetch_search(client: httpx.AsyncClient, query: str, params: Dict[str, Any]) -> tuple:
+    """1クエリ分のYouTube検索を実行し、(クエリ, パース済みレスポンス)を返す"""
+    response = await client.get(YOUTUBE_BASE_URL, params=params, timeout=_REQUEST_TIMEOUT)
+    response.raise_for_status()
+    return query, orjson.loads(response.content)
+
+
+async def _search_videos(condition: WeatherCondition, language: Language) -> List[Dict[str, Any]]:
+    """YouTube APIで天気条件に合った動画を検索"""
+    # 適切な検索クエリを選択（フォールバック解決済みのテーブルから1回で引く）
+    queries = _QUERY_TABLE[(condition, language)]
+
+    # 全クエリを並列に発行し、合計待ち時間を最長の1件分に抑える
+    region_code = _REGION_CODE[language]
+    params_list = [
+        {
+            "part": "snippet",
+            "q": query,
+            "key": YOUTUBE_API_KEY,
+            "type": "video",
+            "maxResults": 3,
+            "regionCode": region_code,
+        }
+        for query in queries
+    ]
+
+    videos = []
+    client = _get_http_client()
+    tasks = [
+        asyncio.create_task(_fetch_search(client, query, params))
+        for query, params in zip(queries, params_list)
+    ]
+
+    # 完了した順に処理し、5本揃った時点で残りを打ち切る。
+    # 期限切れの場合も、間に合った分だけの部分的な結果を返す
+    try:
+        for future in asyncio.as_completed(tasks, timeout=_SEARCH_DEADLINE):
+            try:
+                query, data = await future
+            except httpx.HTTPError:
+                # 失敗したクエリはスキップ（従来のcontinueと同じ扱い）
+                continue
+
+            for item in data.get("items", []):
+                videos.append(_build_video(item, query))
+                if len(videos) >= 5:  # 5本集まったら終了
+                    break
+
+            if len(videos) >= 5:
+                break
+    except asyncio.TimeoutError:
+        pass
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+            elif not task.cancelled():
+                # 早期break後に完了済みのタスクの例外も取り出しておく。
+                # 放置すると"Task exception was never retrieved"の警告が出る
+                task.exception()
+
+    return videos
+
+
+async def suggest_videos(weather_info: WeatherInfo) -> Union[Dict[str, Any], List[Dict[str, Any]]]:
     """
     天気情報に基づいてYouTube動画を提案
-    
+
     Args:
-        weather_info: get_weather_forecastの返り値
-    
+        weather_info: get_weather_forecastの返り値（正常系）
+
     Returns:
         おすすめ動画のリスト
     """
     if not YOUTUBE_API_KEY:
         return [{"error": "YouTube API key not configured"}]
-    
-    if "error" in weather_info:
-        return [{"error": f"Invalid weather info: {weather_info['error']}"}]
-    
-    # 天気条件と言語を取得
-    condition = WeatherCondition(weather_info.get("condition", "perfect"))
-    language = Language(weather_info.get("language", "en"))
-    
-    # 適切な検索クエリを選択
-    queries = SEARCH_QUERIES.get(condition, {}).get(language, SEARCH_QUERIES[condition][Language.EN])
-    
-    # YouTube APIで動画を検索
-    videos = []
-    async with httpx.AsyncClient() as client:
-        for query in queries[:2]:  # 最初の2つのクエリを使用
-            params = {
-                "part": "snippet",
-                "q": query,
-                "key": YOUTUBE_API_KEY,
-                "type": "video",
-                "maxResults": 3,
-                "regionCode": language.value[:2].upper() if language != Language.EN else "US",
-            }
-            
-            try:
-                response = await client.get(YOUTUBE_BASE_URL, params=params)
-                response.raise_for_status()
-                data = response.json()
-                
-                for item in data.get("items", []):
-                    video = {
-                        "title": item["snippet"]["title"],
-                        "channel": item["snippet"]["channelTitle"],
-                        "description": item["snippet"]["description"][:200] + "...",
-                        "url": f"https://www.youtube.com/watch?v={item['id']['videoId']}",
-                        "thumbnail": item["snippet"]["thumbnails"]["medium"]["url"],
-                        "search_query": query,
-                    }
-                    videos.append(video)
-                    
-                    if len(videos) >= 5:  # 5本集まったら終了
-                        break
-            except httpx.HTTPError as e:
-                continue
-            
-            if len(videos) >= 5:
-                break
+
+    # 天気条件と言語を取得（Enumのまま受け取るので文字列との往復変換は不要）
+    condition = weather_info.condition
+    language = weather_info.language
+
+    # 検索クエリは(天気条件, 言語)だけで決まるため、動画リストも同じキーでキャッシュできる
+    videos = _video_cache.get((condition, language))
+    if videos is None:
+        videos = await _search_videos(condition, language)
+        if len(videos) >= 5:
+            # 5本揃った完全な結果だけをキャッシュする。期限切れで打ち切った
+            # 部分的なリストを5分間も固定しないよう、そのまま返すにとどめる
+            _video_cache[(condition, language)] = videos
     
     # 結果にコンテキストを追加
     result = {
-        "weather_summary": f"{weather_info['city']} - {weather_info['date']}: {weather_info['weather']['description']} ({weather_info['weather']['temperature']}°C)",
+        "weather_summary": f"{weather_info.city} - {weather_info.date}: {weather_info.description} ({weather_info.temperature}°C)",
         "suggestion_reason": _get_suggestion_reason(condition, language),
         "videos": videos[:5],  # 最大5本
     }
-    
+
     return result
 
 
+# 天気条件に応じた提案理由（呼び出しごとにdictリテラルを再構築しないよう定数化）
+_REASONS = {
+    WeatherCondition.PERFECT: {
+        Language.JA: "素晴らしい天気です！外出を楽しむのに最適な日です。",
+        Language.EN: "Perfect weather! It's a great day to enjoy outdoor activities.",
+    },
+    WeatherCondition.HOT: {
+        Language.JA: "とても暑い日になりそうです。涼しい室内で快適に過ごしましょう。",
+        Language.EN: "It's going to be very hot. Stay cool and comfortable indoors.",
+    },
+    WeatherCondition.COLD: {
+        Language.JA: "寒い日になりそうです。温かい室内で心地よく過ごしましょう。",
+        Language.EN: "It's going to be cold. Stay warm and cozy indoors.",
+    },
+    WeatherCondition.RAINY: {
+        Language.JA: "雨の日は室内でゆったりと。読書や音楽を楽しむのに最適です。",
+        Language.EN: "A rainy day is perfect for indoor activities. Enjoy some music or a good book.",
+    },
+    WeatherCondition.STORMY: {
+        Language.JA: "荒天が予想されます。安全を第一に、リラックスして過ごしましょう。",
+        Language.EN: "Stormy weather expected. Stay safe and relaxed indoors.",
+    },
+}
+
+# _QUERY_TABLEと同様、英語フォールバックを解決したフラットな表をインポート時に展開しておく
+_REASON_TABLE: Dict[tuple, str] = {
+    (cond, lang): by_lang.get(lang, by_lang[Language.EN])
+    for cond, by_lang in _REASONS.items()
+    for lang in Language
+}
+
+
 def _get_suggestion_reason(condition: WeatherCondition, language: Language) -> str:
     """提案理由を生成"""
-    reasons = {
-        WeatherCondition.PERFECT: {
-            Language.JA: "素晴らしい天気です！外出を楽しむのに最適な日です。",
-            Language.EN: "Perfect weather! It's a great day to enjoy outdoor activities.",
-        },
-        WeatherCondition.HOT: {
-            Language.JA: "とても暑い日になりそうです。涼しい室内で快適に過ごしましょう。",
-            Language.EN: "It's going to be very hot. Stay cool and comfortable indoors.",
-        },
-        WeatherCondition.COLD: {
-            Language.JA: "寒い日になりそうです。温かい室内で心地よく過ごしましょう。",
-            Language.EN: "It's going to be cold. Stay warm and cozy indoors.",
-        },
-        WeatherCondition.RAINY: {
-            Language.JA: "雨の日は室内でゆったりと。読書や音楽を楽しむのに最適です。",
-            Language.EN: "A rainy day is perfect for indoor activities. Enjoy some music or a good book.",
-        },
-        WeatherCondition.STORMY: {
-            Language.JA: "荒天が予想されます。安全を第一に、リラックスして過ごしましょう。",
-            Language.EN: "Stormy weather expected. Stay safe and relaxed indoors.",
-        },
-    }
-    
-    return reasons.get(condition, {}).get(language, reasons[condition][Language.EN])
+    return _REASON_TABLE[(condition, language)]
 
 
 @mcp.tool()
@@ -314,22 +520,38 @@ async def get_activity_suggestion(city: str, days_ahead: int = 0) -> Dict[str, A
     Returns:
         天気情報と動画提案を含む完全な結果
     """
-    # Step 1: 天気情報を取得
+    # Step 1: 天気情報を取得（同時にYouTube側の接続も投機的に温めておく）
+    # ただし入力不正・APIキー未設定・キャッシュで完結するリクエストでは
+    # YouTubeへの通信自体が発生しないため、ウォームアップも出さない
+    if OPENWEATHER_API_KEY and YOUTUBE_API_KEY and 0 <= days_ahead <= 5:
+        cached_weather = _weather_cache.get((city.lower().strip(), days_ahead))
+        if cached_weather is None or (cached_weather.condition, cached_weather.language) not in _video_cache:
+            _spawn_warm_youtube()
+
     weather_info = await get_weather_forecast(city, days_ahead)
-    
-    if "error" in weather_info:
+
+    if isinstance(weather_info, dict):  # エラー時はdictで返る
         return weather_info
-    
+
     # Step 2: 動画を提案
     video_suggestions = await suggest_videos(weather_info)
-    
-    # 結果を統合
+
+    # 結果を統合（MCPレスポンス境界でのみ辞書化する）
     return {
-        "weather": weather_info,
+        "weather": weather_info.to_dict(),
         "suggestions": video_suggestions,
     }
 
 
 if __name__ == "__main__":
+    # 利用可能ならlibuvベースのイベントループに切り替える（I/Oバウンドなサーバーのため効果が大きい）
+    try:
+        import uvloop
+
+        uvloop.install()
+    except ImportError:
+        # uvloopはUnix専用。Windowsなどでは標準のイベントループのまま動かす
+        pass
+
     # サーバーを起動
     mcp.run(transport="stdio")
\ No newline at end of file